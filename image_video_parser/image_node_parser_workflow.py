@@ -2,9 +2,11 @@ from llama_index.core.schema import NodeRelationship, Node,MediaResource
 from llama_index.core.workflow import Event, StartEvent, StopEvent, Workflow, step
 from llama_index.core.workflow.errors import WorkflowRuntimeError
 from llama_index.core.multi_modal_llms import MultiModalLLM
+import asyncio
 import logging
+import re
+import threading
 from PIL import Image
-from sam2.automatic_mask_generator import SAM2ImagePredictor
 from typing import Optional
 import numpy as np
 import torch
@@ -12,9 +14,13 @@ from PIL import Image
 import numpy as np
 import torch
 
-from .object_segmentation_model import ImageSegmentationModel
+from .object_segmentation_model import ImageSegmentationModel, _freeze_sam2_settings, _get_sam2_predictor_lock, _load_sam2
 from .object_detection_model import ObjectDetectionModel
-from .utils import create_node_from_base_64_string, create_node_from_image, image_to_base64_string, resolve_image, try_get_source_ref_node_info, ImageRegion
+from .utils import create_node_from_base_64_string, create_node_from_image, create_node_from_image_path, crop_masked_region, ensure_image_resource_data, resolve_image_tensor, resolve_pil_image, try_get_source_ref_node_info, BBoxes, ImageRegion
+
+
+# Matches a numbered line of a batched description response, e.g. "3. A red chair" or "3) A red chair"
+_NUMBERED_LINE_PATTERN = re.compile(r"^\s*(\d+)\s*[.):-]\s*(.+)$")
 
 
 class ImageLoadedEvent(Event):
@@ -26,11 +32,11 @@ class ImageLoadedEvent(Event):
 
     Attributes:
         image (Node): The loaded image node.
-        bbox_list (Optional[list[ImageRegion]]): A list of bounding boxes associated with the image, if any.
+        bbox_list (Optional[BBoxes | list[ImageRegion]]): The bounding boxes associated with the image, if any.
         prompt (Optional[str]): An optional prompt associated with the image.
     """
     image: Node
-    bbox_list: Optional[list[ImageRegion]]
+    bbox_list: Optional[BBoxes | list[ImageRegion]]
     prompt: Optional[str]
 
 
@@ -40,9 +46,10 @@ class BBoxCreatedEvent(Event):
 
     Attributes:
         image (Node): The image associated with the bounding box.
+        bboxes (BBoxes): The bounding boxes of the objects in the image.
     """
     image: Node
-    bbox_list: list[ImageRegion]
+    bboxes: BBoxes
 
 
 class ImageParsedEvent(Event):
@@ -69,6 +76,9 @@ class ImageNodeParserWorkflow(Workflow):
         _default_predictor_configuration (dict): Default configuration for the predictor model.
         _object_detection_configuration (dict): Configuration for object detection parameters.
         multi_modal_llm (Optional[MultiModalLLM]): The multi-modal language model used for generating prompts and descriptions.
+        max_concurrent_descriptions (int): The maximum number of concurrent description requests sent to the multi-modal language model.
+        max_batched_descriptions (int): The maximum number of image chunks described with a single multi-image request.
+        max_concurrent_detections (int): The maximum number of images going through object detection at the same time.
         processor (Optional[AutoProcessor]): The processor for handling image processing tasks.
         model (Optional[Owlv2ForObjectDetection]): The object detection model.
     """
@@ -76,6 +86,10 @@ class ImageNodeParserWorkflow(Workflow):
     multi_modal_llm: Optional[MultiModalLLM] = None
     object_detection_model: Optional[ObjectDetectionModel] = None
     image_segmentation_model: Optional[ImageSegmentationModel] = None
+    max_concurrent_descriptions: int = 8
+    max_batched_descriptions: int = 16
+    max_concurrent_detections: int = 2
+    _detection_semaphore: Optional[threading.BoundedSemaphore] = None
 
     @step()
     async def load_image(self, start_event: StartEvent) -> ImageLoadedEvent | StopEvent:
@@ -105,9 +119,13 @@ class ImageNodeParserWorkflow(Workflow):
         elif hasattr(start_event, "base64_image") and start_event.base64_image is not None:
             image_document = create_node_from_base_64_string(base64_string=start_event.base64_image)
         elif hasattr(start_event, "image_path") and start_event.image_path is not None:
-            image_document = create_node_from_image(image=Image.open(start_event.image_path).convert("RGB"))
+            image_document = create_node_from_image_path(image_path=start_event.image_path)
         else:
             return StopEvent()
+
+        # The source node is returned with the result and its hash is recorded by the relationships of
+        # the chunks, so its image is encoded once before being used
+        ensure_image_resource_data(image_document)
         
         return ImageLoadedEvent(image=image_document, bbox_list=bbox_list, prompt=prompt)
         
@@ -124,21 +142,26 @@ class ImageNodeParserWorkflow(Workflow):
             StopEvent: If bounding box creation fails due to an error.
         """
         try:
-            bbox_list = image_loaded_event.bbox_list
-            if bbox_list is None:
+            bboxes = image_loaded_event.bbox_list
+            if isinstance(bboxes, list):
+                bboxes = BBoxes.from_regions(bboxes)
+            elif bboxes is None:
                 prompt = image_loaded_event.prompt
                 if prompt is None:
-                    prompt = self.multi_modal_llm.complete(
+                    prompt = (await self.multi_modal_llm.acomplete(
                         "Find the most important entities (10 maximum) in the image and produce a list of short prompts to use for an object detection model. Give priorities to people, foreground elements, animals. Put each single prompt on a new line. Emit only the prompts without any punctuation.",
                         [image_loaded_event.image]
-                    ).text
+                    )).text
                 
-                bbox_list = self.object_detection_model.detect_bboxes(
+                # Run the detection off the event loop so other images can make progress meanwhile
+                bboxes = await asyncio.to_thread(
+                    self._detect_bboxes,
+                    self._get_or_create_detection_semaphore(),
                     image_loaded_event.image,
-                    prompt=prompt,
+                    prompt,
                 )
 
-            return BBoxCreatedEvent(image=image_loaded_event.image, bbox_list=bbox_list)
+            return BBoxCreatedEvent(image=image_loaded_event.image, bboxes=bboxes)
                 
         except Exception as e:
             logging.error(f"Failed to create bounding boxes: {e}", exc_info=True)
@@ -159,9 +182,11 @@ class ImageNodeParserWorkflow(Workflow):
         """
         parsed: list[Node] = []
         image = bounding_boxes_created_event.image
-        bbox_list = bounding_boxes_created_event.bbox_list
+        bboxes = bounding_boxes_created_event.bboxes
 
-        parsed = self.image_segmentation_model.segment_image(image, bbox_list)
+        # Run the segmentation off the event loop, the segmentation model serializes the images sharing
+        # the same predictor
+        parsed = await asyncio.to_thread(self.image_segmentation_model.segment_image, image, bboxes)
 
         if len(parsed) == 0:
             result = {
@@ -177,9 +202,12 @@ class ImageNodeParserWorkflow(Workflow):
         """
         Generates descriptions for each chunk of the parsed image.
 
-        This method iterates over the image chunks in the parsed event and uses a multi-modal
-        language model to generate textual descriptions for each chunk. The descriptions are
-        stored as TextNode instances with associated relationships to the source and parent nodes.
+        This method uses a multi-modal language model to generate textual descriptions for the image
+        chunks in the parsed event. Up to max_batched_descriptions chunks are described with a single
+        multi-image request; when there are more chunks or the response cannot be split into one
+        description per chunk, each chunk is described on its own, running up to
+        max_concurrent_descriptions requests concurrently. The descriptions are stored as TextNode
+        instances with associated relationships to the source and parent nodes.
 
         Args:
             image_parsed_event (ImageParsedEvent): The event containing the parsed image and its chunks.
@@ -191,28 +219,22 @@ class ImageNodeParserWorkflow(Workflow):
         
         # Check if a multi-modal language model is available
         if self.multi_modal_llm is not None:
-            # Iterate over each chunk of the parsed image
-            for image_chunk in image_parsed_event.chunks:
-                try:
-                    # Use the multi-modal language model to generate a description for the image chunk
-                    image_description = self.multi_modal_llm.complete(
-                        prompt="Describe the image above in a few words.",
-                        image_documents=[image_chunk],
-                    )
-                    # Create a TextNode to store the generated description
-                    image_description_node = Node(
-                        text_resource=MediaResource(text=image_description.text, mimetype="text/plain"),
-                        mimetype="text/plain"
-                    )
-                    # Establish a relationship between the description node and the source image node
-                    image_description_node.relationships[NodeRelationship.SOURCE] = try_get_source_ref_node_info(image_parsed_event.source)
-                    # Establish a parent relationship to the current image chunk
-                    image_description_node.relationships[NodeRelationship.PARENT] = image_chunk.as_related_node_info()
-                    # Append the description node to the list of image descriptions
-                    image_descriptions.append(image_description_node)
-                except Exception:
-                    # If an error occurs during description generation, append None to maintain list integrity
-                    image_descriptions.append(None)
+            descriptions = None
+            if 1 < len(image_parsed_event.chunks) <= self.max_batched_descriptions:
+                # Describe all the chunks with a single request
+                descriptions = await self._describe_image_chunks_in_batch(image_parsed_event.chunks)
+
+            if descriptions is not None:
+                image_descriptions = [
+                    self._create_description_node(description, image_chunk, image_parsed_event.source)
+                    for description, image_chunk in zip(descriptions, image_parsed_event.chunks)
+                ]
+            else:
+                # Describe all the chunks concurrently, bounded to respect the rate limits of the model
+                semaphore = asyncio.Semaphore(self.max_concurrent_descriptions)
+                image_descriptions = await asyncio.gather(
+                    *[self._describe_image_chunk(image_chunk, image_parsed_event.source, semaphore) for image_chunk in image_parsed_event.chunks]
+                )
           
         result = {
             "source": image_parsed_event.source,
@@ -222,6 +244,129 @@ class ImageNodeParserWorkflow(Workflow):
 
         return StopEvent(result=result)
 
+    async def run_batch(self, image_paths: list[str], **kwargs) -> list:
+        """
+        Runs the workflow on a batch of images.
+
+        The images go through the workflow concurrently, so the detection, segmentation and description
+        of different images overlap instead of running one image after the other.
+
+        Args:
+            image_paths (list[str]): The paths of the images to parse.
+            **kwargs: Additional arguments passed to each run, such as the prompt.
+
+        Returns:
+            list: The result of the workflow for each image, in the same order as the image paths.
+        """
+        return await asyncio.gather(*[self.run(image_path=image_path, **kwargs) for image_path in image_paths])
+
+    def _get_or_create_detection_semaphore(self) -> threading.BoundedSemaphore:
+        """
+        Retrieves or creates the semaphore bounding the concurrent object detections.
+
+        The semaphore is acquired by the worker threads running the detections, unlike an asyncio
+        primitive it is not bound to an event loop, so the workflow can be run from several loops.
+
+        Returns:
+            threading.BoundedSemaphore: The semaphore allowing up to max_concurrent_detections detections.
+        """
+        if self._detection_semaphore is None:
+            self._detection_semaphore = threading.BoundedSemaphore(self.max_concurrent_detections)
+        return self._detection_semaphore
+
+    def _detect_bboxes(self, semaphore: threading.BoundedSemaphore, image: Node, prompt: str) -> BBoxes:
+        """
+        Detects the bounding boxes of an image, waiting for a free detection slot first.
+
+        Args:
+            semaphore (threading.BoundedSemaphore): The semaphore bounding the concurrent detections.
+            image (Node): The image node to process.
+            prompt (str): The prompt for the object detection model.
+
+        Returns:
+            BBoxes: The detected bounding boxes.
+        """
+        with semaphore:
+            return self.object_detection_model.detect_bboxes(image, prompt=prompt)
+
+    async def _describe_image_chunk(self, image_chunk: Node, source: Node, semaphore: asyncio.Semaphore) -> Optional[Node]:
+        """
+        Generates the description of a single chunk of the parsed image.
+
+        Args:
+            image_chunk (Node): The image chunk to describe.
+            source (Node): The original image node the chunk was parsed from.
+            semaphore (asyncio.Semaphore): The semaphore bounding the concurrent calls to the model.
+
+        Returns:
+            Optional[Node]: The description node, or None if the description could not be generated.
+        """
+        try:
+            async with semaphore:
+                # Use the multi-modal language model to generate a description for the image chunk
+                image_description = await self.multi_modal_llm.acomplete(
+                    prompt="Describe the image above in a few words.",
+                    image_documents=[image_chunk],
+                )
+            return self._create_description_node(image_description.text, image_chunk, source)
+        except Exception:
+            # If an error occurs during description generation, return None to maintain list integrity
+            return None
+
+    async def _describe_image_chunks_in_batch(self, image_chunks: list[Node]) -> Optional[list[str]]:
+        """
+        Generates the descriptions of several chunks of the parsed image with a single request.
+
+        Args:
+            image_chunks (list[Node]): The image chunks to describe.
+
+        Returns:
+            Optional[list[str]]: The description of each chunk, in the same order as the chunks, or None if
+            the request failed or the response could not be split into one description per chunk.
+        """
+        try:
+            response = await self.multi_modal_llm.acomplete(
+                prompt=f"Describe each of the {len(image_chunks)} images above in a few words. Number the descriptions 1..{len(image_chunks)} following the order of the images and put each description on a new line.",
+                image_documents=image_chunks,
+            )
+        except Exception as e:
+            logging.warning(f"Failed to describe {len(image_chunks)} image chunks with a single request, describing them one by one: {e}", exc_info=True)
+            return None
+
+        descriptions: dict[int, str] = {}
+        for line in response.text.splitlines():
+            match = _NUMBERED_LINE_PATTERN.match(line)
+            if match is not None:
+                descriptions[int(match.group(1))] = match.group(2).strip()
+
+        if sorted(descriptions) != list(range(1, len(image_chunks) + 1)):
+            logging.warning(f"Could not split the batched response into {len(image_chunks)} descriptions, describing the image chunks one by one: {response.text!r}")
+            return None
+        return [descriptions[i] for i in range(1, len(image_chunks) + 1)]
+
+    def _create_description_node(self, description: str, image_chunk: Node, source: Node) -> Node:
+        """
+        Creates the node storing the description of a chunk of the parsed image.
+
+        Args:
+            description (str): The generated description.
+            image_chunk (Node): The described image chunk.
+            source (Node): The original image node the chunk was parsed from.
+
+        Returns:
+            Node: The description node.
+        """
+        # Create a TextNode to store the generated description
+        image_description_node = Node(
+            text_resource=MediaResource(text=description, mimetype="text/plain"),
+            mimetype="text/plain"
+        )
+        # Establish a relationship between the description node and the source image node
+        image_description_node.relationships[NodeRelationship.SOURCE] = try_get_source_ref_node_info(source)
+        # Establish a parent relationship to the current image chunk
+        image_description_node.relationships[NodeRelationship.PARENT] = image_chunk.as_related_node_info()
+        return image_description_node
+
     def _parse_image_node_with_sam2(self, image_node: Node, configuration: dict) -> list[Node]:
         """
         Parses an image node by cropping it into smaller image chunks based on the provided annotations.
@@ -233,48 +378,51 @@ class ImageNodeParserWorkflow(Workflow):
         Returns:
             list[Node]: A list of image chunks generated from the cropping process.
         """
-        img = Image.open(resolve_image(image_node)).convert("RGB")
+        bboxes = configuration["bbox_list"]
+        if isinstance(bboxes, list):
+            bboxes = BBoxes.from_regions(bboxes)
+        if len(bboxes) == 0:
+            return []
+
+        img = resolve_pil_image(image_node)
 
         sam_settings = configuration.get("sam_settings", {})
 
-        predictor = SAM2ImagePredictor.from_pretrained(configuration["model_name"], device="cpu", **sam_settings)
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        predictor = _load_sam2(configuration["model_name"], device, False, _freeze_sam2_settings(sam_settings))
 
-        with torch.inference_mode(), torch.autocast("cuda", dtype=torch.bfloat16):
+        # Decode the masks for all the bounding boxes in a single batched forward
+        with _get_sam2_predictor_lock(predictor), torch.inference_mode(), torch.autocast(device_type=predictor.device.type, dtype=torch.bfloat16):
             predictor.set_image(img)
-                
-            annotations = []
-            for bbox in configuration["bbox_list"]:
-                x1, y1, x2, y2 = bbox.x1, bbox.y1, bbox.x2, bbox.y2
-                annotations.append(predictor.predict(box=(x1, y1, x2, y2)))
-
-            # Initialize a list to hold the generated image chunks
-            image_chunks = []
-            # Iterate over the annotations and corresponding bounding boxes
-            for ann, bbox in zip(annotations, configuration["bbox_list"]):
-                # Extract the coordinates of the bounding box
-                box = bbox.x1, bbox.y1, bbox.x2, bbox.y2
-                # Create a mask from the annotation array
-                mask = Image.fromarray(ann[0][-1].astype(np.uint8))
-                # Composite the original image with a new RGB image using the mask
-                masked_image = Image.composite(img, Image.new("RGB", img.size), mask)
-                # Crop the masked image to the bounding box dimensions
-                cropped_image = masked_image.crop(box)
-
-                # Prepare metadata for the image chunk
-                x1, y1, x2, y2 = box
-                region = dict(x1=x1, y1=y1, x2=x2, y2=y2)
-                metadata = dict(region=region)
-                try:
-                    # Create an ImageNode from the cropped image and set its relationships
-                    image_chunk = create_node_from_image(image=image_to_base64_string(cropped_image), metadata=metadata)
-                    image_chunk.relationships[NodeRelationship.SOURCE] = try_get_source_ref_node_info(image_node)
-                    image_chunk.relationships[NodeRelationship.PARENT] = image_node.as_related_node_info()
-                    # Append the created image chunk to the list
-                    image_chunks.append(image_chunk)
-                except Exception as e:
-                    # Handle any exceptions by sending a workflow runtime error event
-                    self.send_event(WorkflowRuntimeError(e))
-                    continue
+            masks, _, _ = predictor.predict(box=bboxes.boxes, multimask_output=False)
+
+        # A single box comes back without the batch dimension
+        if masks.ndim == 3:
+            masks = masks[None]
+
+        img_t = resolve_image_tensor(image_node)
+        # Initialize a list to hold the generated image chunks
+        image_chunks = []
+        # Iterate over the predicted masks and corresponding bounding boxes
+        for bbox_masks, box in zip(masks, bboxes.boxes.astype(np.int32).tolist()):
+            # Crop the bounding box and apply the predicted mask to the cropped region
+            cropped_image = crop_masked_region(img_t, torch.from_numpy(bbox_masks[-1]), box)
+
+            # Prepare metadata for the image chunk
+            x1, y1, x2, y2 = box
+            region = dict(x1=x1, y1=y1, x2=x2, y2=y2)
+            metadata = dict(region=region)
+            try:
+                # Create an ImageNode from the cropped image and set its relationships
+                image_chunk = create_node_from_image(image=cropped_image, metadata=metadata)
+                image_chunk.relationships[NodeRelationship.SOURCE] = try_get_source_ref_node_info(image_node)
+                image_chunk.relationships[NodeRelationship.PARENT] = image_node.as_related_node_info()
+                # Append the created image chunk to the list
+                image_chunks.append(image_chunk)
+            except Exception as e:
+                # Handle any exceptions by sending a workflow runtime error event
+                self.send_event(WorkflowRuntimeError(e))
+                continue
 
         children_collection = image_node.relationships.get(NodeRelationship.CHILD, [])
         image_node.relationships[NodeRelationship.CHILD] = children_collection + [c.as_related_node_info() for c in image_chunks[1:]]
@@ -0,0 +1,62 @@
+from typing import Any, Optional
+import httpx
+from openai import AsyncOpenAI
+from openai.lib.azure import AsyncAzureOpenAI
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.multi_modal_llms.openai import OpenAIMultiModal
+from llama_index.multi_modal_llms.azure_openai import AzureOpenAIMultiModal
+
+def create_pooled_async_http_client(
+        max_connections: int = 32,
+        max_keepalive_connections: int = 16,
+        timeout: float = 60.0,
+    ) -> httpx.AsyncClient:
+    """
+    Creates the HTTP/2 client shared by the asynchronous requests of a multi-modal language model.
+
+    The concurrent description requests are multiplexed over a few pooled connections instead of
+    paying a TCP and TLS handshake each.
+
+    Args:
+        max_connections (int): The maximum number of connections of the pool.
+        max_keepalive_connections (int): The maximum number of idle connections kept alive.
+        timeout (float): The timeout of the requests, in seconds.
+
+    Returns:
+        httpx.AsyncClient: The pooled HTTP/2 client.
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections),
+        timeout=timeout,
+    )
+
+
+class PooledOpenAIMultiModal(OpenAIMultiModal):
+    """
+    OpenAIMultiModal sending its asynchronous requests through a pooled HTTP/2 client.
+
+    OpenAIMultiModal only forwards a synchronous http_client to the OpenAI SDK, so the asynchronous
+    SDK client is created again around the pooled client once the model is initialized.
+    """
+    _async_http_client: httpx.AsyncClient = PrivateAttr()
+
+    def __init__(self, async_http_client: Optional[httpx.AsyncClient] = None, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._async_http_client = async_http_client or create_pooled_async_http_client(timeout=self.timeout)
+        self._aclient = AsyncOpenAI(**{**self._get_credential_kwargs(), "http_client": self._async_http_client})
+
+
+class PooledAzureOpenAIMultiModal(AzureOpenAIMultiModal):
+    """
+    AzureOpenAIMultiModal sending its asynchronous requests through a pooled HTTP/2 client.
+
+    AzureOpenAIMultiModal only forwards a synchronous http_client to the OpenAI SDK, so the
+    asynchronous SDK client is created again around the pooled client once the model is initialized.
+    """
+    _async_http_client: httpx.AsyncClient = PrivateAttr()
+
+    def __init__(self, async_http_client: Optional[httpx.AsyncClient] = None, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._async_http_client = async_http_client or create_pooled_async_http_client(timeout=self.timeout)
+        self._aclient = AsyncAzureOpenAI(**{**self._get_credential_kwargs(), "http_client": self._async_http_client})
@@ -1,40 +1,107 @@
 import abc
+import os
+import threading
+from functools import lru_cache
 from typing import Literal, Optional
 import torch
 import numpy as np
 from PIL import Image
 from llama_index.core.schema import Node
 from transformers import AutoProcessor, Owlv2ForObjectDetection, AutoProcessor, AutoModelForCausalLM
-from transformers.utils.constants import OPENAI_CLIP_MEAN, OPENAI_CLIP_STD
+from transformers.models.owlv2.modeling_owlv2 import Owlv2ObjectDetectionOutput
 
-from .utils import ImageRegion, resolve_image
+from .utils import BBoxes, ImageRegion, resolve_pil_image
 from .owl_v2 import Owlv2ProcessorWithNMS
 
+_TEXT_FEATURE_CACHE_SIZE = 16
+# Serializes the lazy creation of the models, processors and ONNX sessions. lru_cache does not stop two
+# threads from loading the same model, and two exports to the same onnx directory would corrupt its files
+_owl_v2_load_lock = threading.Lock()
+
+@lru_cache(maxsize=2)
+def _load_owl_v2(model_name: str, device: str, torch_dtype: torch.dtype = torch.float32, compile_model: bool = False) -> Owlv2ForObjectDetection:
+    """
+    Loads the Owlv2ForObjectDetection model, shared by all the detectors of the process.
+
+    Args:
+        model_name (str): The name of the pretrained model.
+        device (str): The device to load the model on.
+        torch_dtype (torch.dtype): The dtype of the model weights.
+        compile_model (bool): Whether to compile the vision and text encoders with torch.compile.
+
+    Returns:
+        Owlv2ForObjectDetection: The object detection model in evaluation mode.
+    """
+    model = Owlv2ForObjectDetection.from_pretrained(model_name, device_map=device, torch_dtype=torch_dtype).eval()
+    if compile_model:
+        # The processor always pads images to the same size, only the number of text queries varies. The
+        # default mode does not record CUDA graphs, which cannot be replayed from several detection threads
+        model.owlv2.vision_model = torch.compile(model.owlv2.vision_model)
+        model.owlv2.text_model = torch.compile(model.owlv2.text_model, dynamic=True)
+
+        # Warm up once so the compilation does not happen on the first user request
+        processor = _load_owl_v2_processor(model_name)
+        inputs = processor(text=[["object"]], images=Image.new("RGB", (processor.image_processor.size["height"],) * 2), return_tensors="pt").to(device)
+        inputs["pixel_values"] = inputs["pixel_values"].to(torch_dtype)
+        with torch.no_grad():
+            model(**inputs)
+    return model
+
+@lru_cache(maxsize=2)
+def _load_owl_v2_processor(model_name: str) -> Owlv2ProcessorWithNMS:
+    """
+    Loads the Owlv2ProcessorWithNMS processor, shared by all the detectors of the process.
+
+    Args:
+        model_name (str): The name of the pretrained model.
+
+    Returns:
+        Owlv2ProcessorWithNMS: The processor instance for handling image processing.
+    """
+    return Owlv2ProcessorWithNMS.from_pretrained(model_name)
+
 class ObjectDetectionModel(abc.ABC):
     @abc.abstractmethod
-    def detect_bboxes(self, image_node: Node, **kwargs) -> list[ImageRegion]:
+    def detect_bboxes(self, image_node: Node, **kwargs) -> BBoxes:
         pass
 
 
 class OwlV2ObjectDetectionModel(ObjectDetectionModel):
     _processor: Optional[AutoProcessor] = None
     _model: Optional[Owlv2ForObjectDetection] = None
+    _session = None
     
     def __init__(
             self,
+            model_name: str = "google/owlv2-base-patch16-ensemble",
             confidence=0.1,
             nms_threshold=0.3,
             save_cropped_images: bool = False,
             output_dir: str = "./output",
-            device: str = "cpu",
+            device: Optional[str] = None,
+            torch_dtype: Optional[torch.dtype] = None,
+            max_image_size: Optional[int] = 1280,
+            use_onnx: bool = False,
+            onnx_dir: str = "./onnx/owlv2",
+            compile_model: bool = False,
         ):
+        self._model_name = model_name
         self._owl_v2 = None
         self._owl_v2_processor = None
         self._save_cropped_images = save_cropped_images
         self._output_dir = output_dir
         self._confidence = confidence
         self._nms_threshold = nms_threshold
-        self._device = device
+        self._device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        # Half precision by default on CUDA. CPUs without native bf16 support emulate it much slower than
+        # fp32, so bf16 is opt-in there
+        self._torch_dtype = torch_dtype or (torch.float16 if torch.device(self._device).type == "cuda" else torch.float32)
+        self._max_image_size = max_image_size
+        self._use_onnx = use_onnx
+        self._onnx_dir = onnx_dir
+        self._compile_model = compile_model
+        self._text_feature_cache: dict[tuple[str, ...], torch.Tensor] = {}
+        self._text_feature_cache_lock = threading.Lock()
 
 
     def _get_or_create_owl_v2(self) -> Owlv2ForObjectDetection:
@@ -45,7 +112,9 @@ class OwlV2ObjectDetectionModel(ObjectDetectionModel):
             Owlv2ForObjectDetection: The object detection model instance.
         """
         if self._model is None:
-            self._model = Owlv2ForObjectDetection.from_pretrained("google/owlv2-base-patch16-ensemble", device_map=self._device).eval()
+            with _owl_v2_load_lock:
+                if self._model is None:
+                    self._model = _load_owl_v2(self._model_name, self._device, self._torch_dtype, self._compile_model)
         return self._model
     
     def _get_or_create_owl_v2_processor(self) -> AutoProcessor:
@@ -56,10 +125,119 @@ class OwlV2ObjectDetectionModel(ObjectDetectionModel):
             AutoProcessor: The processor instance for handling image processing.
         """
         if self._processor is None:
-            self._processor = Owlv2ProcessorWithNMS.from_pretrained("google/owlv2-base-patch16-ensemble")
+            with _owl_v2_load_lock:
+                if self._processor is None:
+                    self._processor = _load_owl_v2_processor(self._model_name)
         return self._processor
 
-    def detect_bboxes(self, image_node: Node, prompt: str, score_threshold: float = 0.1, **kwargs) -> list[ImageRegion]:
+    def _get_or_create_owl_v2_session(self):
+        """
+        Retrieves or creates an ONNX Runtime session running the INT8 dynamically quantized Owlv2 model.
+
+        The model is exported to ONNX and quantized once, then the graph optimized by ONNX Runtime
+        (constant folding, node elimination, attention fusion) is stored in the onnx directory and
+        reused by subsequent runs.
+
+        Returns:
+            onnxruntime.InferenceSession: The inference session for the quantized model.
+        """
+        if self._session is None:
+            with _owl_v2_load_lock:
+                if self._session is None:
+                    self._session = self._create_owl_v2_session()
+        return self._session
+
+    def _create_owl_v2_session(self):
+        """
+        Exports, quantizes and optimizes the Owlv2 model if needed, then creates its ONNX Runtime session.
+
+        Returns:
+            onnxruntime.InferenceSession: The inference session for the quantized model.
+        """
+        import onnxruntime
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        providers = [p for p in ["CUDAExecutionProvider", "CPUExecutionProvider"] if p in onnxruntime.get_available_providers()]
+
+        quantized_model_path = os.path.join(self._onnx_dir, "owlv2_int8.onnx")
+        # The optimized graph is tied to the execution providers it was optimized for, so it is only reused
+        # with the same providers and optimized again for any other set
+        provider_names = "_".join(p.removesuffix("ExecutionProvider").lower() for p in providers)
+        optimized_model_path = os.path.join(self._onnx_dir, f"owlv2_opt_{provider_names}.onnx")
+        if not os.path.exists(quantized_model_path):
+            from optimum.exporters.onnx import main_export
+
+            main_export(self._model_name, output=self._onnx_dir, task="zero-shot-object-detection")
+            quantize_dynamic(
+                model_input=os.path.join(self._onnx_dir, "model.onnx"),
+                model_output=quantized_model_path,
+                weight_type=QuantType.QInt8,
+                op_types_to_quantize=["MatMul", "Attention"],
+            )
+
+        sess_options = onnxruntime.SessionOptions()
+        if os.path.exists(optimized_model_path):
+            # The serialized graph is already optimized, skip doing it again on load
+            model_path = optimized_model_path
+            sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+        else:
+            model_path = quantized_model_path
+            sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            sess_options.optimized_model_filepath = optimized_model_path
+
+        return onnxruntime.InferenceSession(model_path, sess_options=sess_options, providers=providers)
+
+    def _run_owl_v2_session(self, inputs) -> Owlv2ObjectDetectionOutput:
+        """
+        Runs the quantized Owlv2 model on the given processor inputs.
+
+        Args:
+            inputs (BatchFeature): The processor outputs holding the input ids, attention mask and pixel values.
+
+        Returns:
+            Owlv2ObjectDetectionOutput: The logits and predicted boxes of the model.
+        """
+        session = self._get_or_create_owl_v2_session()
+        session_inputs = {i.name: inputs[i.name].cpu().numpy() for i in session.get_inputs()}
+        logits, pred_boxes = session.run(["logits", "pred_boxes"], session_inputs)
+        return Owlv2ObjectDetectionOutput(logits=torch.from_numpy(logits), pred_boxes=torch.from_numpy(pred_boxes))
+
+    def _forward_owl_v2(self, model: Owlv2ForObjectDetection, inputs: dict, queries: tuple[str, ...]) -> Owlv2ObjectDetectionOutput:
+        """
+        Runs the Owlv2 model, reusing the text embeddings already computed for the same queries.
+
+        Args:
+            model (Owlv2ForObjectDetection): The object detection model.
+            inputs (dict): The processor outputs holding the input ids, attention mask and pixel values.
+            queries (tuple[str, ...]): The text queries the input ids were created from.
+
+        Returns:
+            Owlv2ObjectDetectionOutput: The logits and predicted boxes of the model.
+        """
+        with self._text_feature_cache_lock:
+            query_embeds = self._text_feature_cache.get(queries)
+        if query_embeds is None:
+            query_embeds = model.owlv2.get_text_features(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"])
+            with self._text_feature_cache_lock:
+                # Keep the cache bounded, prompts generated by the multi-modal model change for every image
+                if queries not in self._text_feature_cache and len(self._text_feature_cache) >= _TEXT_FEATURE_CACHE_SIZE:
+                    self._text_feature_cache.pop(next(iter(self._text_feature_cache)))
+                self._text_feature_cache[queries] = query_embeds
+
+        feature_map, _ = model.image_embedder(pixel_values=inputs["pixel_values"])
+        batch_size, num_patches_height, num_patches_width, hidden_dim = feature_map.shape
+        image_feats = feature_map.reshape(batch_size, num_patches_height * num_patches_width, hidden_dim)
+
+        # Reshape from [batch_size * max_text_queries, hidden_dim] to [batch_size, max_text_queries, hidden_dim]
+        query_embeds = query_embeds.reshape(batch_size, -1, query_embeds.shape[-1])
+        # If the first token is 0, then this is a padded query
+        query_mask = inputs["input_ids"].reshape(batch_size, query_embeds.shape[1], -1)[..., 0] > 0
+
+        logits, _ = model.class_predictor(image_feats, query_embeds, query_mask)
+        pred_boxes = model.box_predictor(image_feats, feature_map)
+        return Owlv2ObjectDetectionOutput(logits=logits, pred_boxes=pred_boxes)
+
+    def detect_bboxes(self, image_node: Node, prompt: str, score_threshold: float = 0.1, **kwargs) -> BBoxes:
         """
         Detects bounding boxes in the image using the Owlv2 model.
 
@@ -70,100 +248,82 @@ class OwlV2ObjectDetectionModel(ObjectDetectionModel):
             nms_threshold (float): The non-maximum suppression threshold.
 
         Returns:
-            list[ImageRegion]: A list of detected bounding boxes with their associated labels and scores.
+            BBoxes: The detected bounding boxes with their associated labels and scores.
         """
-        image = Image.open(resolve_image(image_node)).convert("RGB")
+        image = resolve_pil_image(image_node)
         processor = self._get_or_create_owl_v2_processor()
-        model = self._get_or_create_owl_v2()
-
-        texts = [[x.strip() for x in prompt.split("\n")]]
-        inputs = processor(text=texts, images=image, return_tensors="pt").to(self._device)
-
-        with torch.no_grad():
-            outputs = model(**inputs)
-
-        # def get_preprocessed_image(pixel_values):
-        #     # Step 1: Remove the batch dimension from pixel_values and convert to numpy array
-        #     pixel_values = pixel_values.squeeze().numpy()
-            
-        #     # Step 2: Unnormalize the image by applying the inverse of CLIP's normalization
-        #     # Multiply by standard deviation and add mean
-        #     unnormalized_image = (pixel_values * np.array(OPENAI_CLIP_STD)[:, None, None]) + np.array(OPENAI_CLIP_MEAN)[:, None, None]
-            
-        #     # Step 3: Scale the pixel values to 0-255 range and convert to 8-bit unsigned integer
-        #     unnormalized_image = (unnormalized_image * 255).astype(np.uint8)
-            
-        #     # Step 4: Rearrange the color channel axis from first to last (CHW to HWC)
-        #     unnormalized_image = np.moveaxis(unnormalized_image, 0, -1)
-            
-        #     # Step 5: Convert the numpy array to a PIL Image object
-        #     unnormalized_image = Image.fromarray(unnormalized_image)
-        #     return unnormalized_image
-
-        # unnormalized_image = get_preprocessed_image(inputs.pixel_values)
-
-        # target_sizes = torch.Tensor([unnormalized_image.size[::-1]])
-        
-        # results = processor.post_process_object_detection_with_nms(
-        #     outputs=outputs, threshold=self._confidence, nms_threshold=self._nms_threshold, target_sizes=target_sizes
-        # )
 
-        # i = 0
-        # text = texts[i]
-        # boxes, scores, labels = results[i]["boxes"], results[i]["scores"], results[i]["labels"]
+        # Downscale high resolution images with a cheap bilinear filter, the processor resizes them to
+        # its much smaller input size anyway
+        scale = 1.0
+        if self._max_image_size is not None:
+            scale = min(1.0, self._max_image_size / max(image.size))
+        detection_image = image
+        if scale < 1.0:
+            detection_image = image.resize((int(image.width * scale), int(image.height * scale)), Image.BILINEAR)
 
-        size = max(image.size[:2])
+        texts = [[x.strip() for x in prompt.split("\n")]]
+        inputs = processor(text=texts, images=detection_image, return_tensors="pt")
+
+        if self._use_onnx:
+            outputs = self._run_owl_v2_session(inputs)
+        else:
+            model = self._get_or_create_owl_v2()
+            if torch.device(self._device).type == "cuda":
+                # Copy from pinned host memory so the transfers to the device run asynchronously
+                inputs = {k: v.pin_memory().to(self._device, non_blocking=True) for k, v in inputs.items()}
+            else:
+                inputs = inputs.to(self._device)
+            inputs["pixel_values"] = inputs["pixel_values"].to(self._torch_dtype)
+            with torch.no_grad():
+                outputs = self._forward_owl_v2(model, inputs, tuple(texts[0]))
+
+        # The processor pads the image to a square before resizing it, so the boxes are scaled back with the
+        # longest side of the detection image instead of unnormalizing the preprocessed pixel values
+        size = max(detection_image.size[:2])
         target_sizes = torch.Tensor([[size, size]])
 
-        outputs.logits = outputs.logits.cpu()
-        outputs.pred_boxes = outputs.pred_boxes.cpu()
+        # The NMS loop reads single scores, keep it on the host to avoid a device sync per box. NMS and
+        # thresholding are numerically sensitive, always run them in fp32
+        outputs.logits = outputs.logits.cpu().float()
+        outputs.pred_boxes = outputs.pred_boxes.cpu().float()
         results = processor.post_process_object_detection_with_nms(outputs=outputs, target_sizes=target_sizes, threshold=self._confidence, nms_threshold=self._nms_threshold)
         # results = processor.post_process_object_detection(outputs=outputs, target_sizes=target_sizes)
         boxes, scores, labels = results[0]["boxes"], results[0]["scores"], results[0]["labels"]
 
-        # Initialize an empty list to store ImageRegion objects
-        annotations: list[ImageRegion] = [] 
-        # Iterate through the detected boxes, scores, and labels
-        for box, score, label in zip(boxes, scores, labels):
-            box = [int(i) for i in box.tolist()]
-            
-            # Skip detections with scores below the threshold
-            if score < score_threshold:
-                continue
-            
-            # Unpack the box coordinates
-            x1, y1, x2, y2 = box
-            
-            # Create an ImageRegion object with the detection information
-            image_region = ImageRegion(x1, y1, x2, y2, label, score)
-            
-            # Add the ImageRegion to the annotations list
-            annotations.append(image_region)
+        # Skip detections with scores below the threshold and scale the boxes back to the original image
+        keep = scores >= score_threshold
+        bboxes = BBoxes(
+            boxes=(boxes[keep] / scale).int().numpy().astype(np.float32),
+            labels=labels[keep].numpy().astype(np.int32),
+            scores=scores[keep].numpy().astype(np.float32),
+            label_names=texts[0],
+        )
         
         if self._save_cropped_images:
-            self._save_crops(image, annotations, self._output_dir)
+            self._save_crops(image, bboxes, self._output_dir)
     
-        return annotations
+        return bboxes
     
-    def _save_crops(self, image: Image, annotations: list[ImageRegion], output_dir: str):
+    def _save_crops(self, image: Image, bboxes: BBoxes, output_dir: str):
         """
-        Saves cropped images based on the provided annotations.
+        Saves cropped images based on the provided bounding boxes.
 
         Args:
             image (Image): The original image to crop.
-            annotations (list[ImageRegion]): A list of ImageRegion objects containing the bounding box coordinates.
+            bboxes (BBoxes): The bounding boxes to crop.
             output_dir (str): The directory to save the cropped images.
         """
-        # Iterate through the annotations
-        for i, annotation in enumerate(annotations):
+        # Iterate through the bounding boxes
+        for i, box in enumerate(bboxes.boxes.astype(np.int32).tolist()):
             # Unpack the bounding box coordinates
-            x1, y1, x2, y2 = annotation.x1, annotation.y1, annotation.x2, annotation.y2
+            x1, y1, x2, y2 = box
             
             # Crop the image using the bounding box coordinates
             crop = image.crop((x1, y1, x2, y2))
             
             # Save the cropped image to the output directory
-            crop.save(f"{output_dir}/crop_{i}.png")
+            crop.save(f"{output_dir}/crop_{i}.png", compress_level=1)
             
             # Print a message indicating the crop has been saved
             print(f"Cropped image saved to {output_dir}/crop_{i}.png")
@@ -234,7 +394,7 @@ class Florence2ForObjectDetectionModel(ObjectDetectionModel):
         Returns:
             list[ImageRegion]: A list of detected bounding boxes with their associated labels and scores.
         """
-        image = Image.open(resolve_image(image_node)).convert("RGB")
+        image = resolve_pil_image(image_node)
         processor = self._get_or_create_florence2_processor()
         model = self._get_or_create_florence2()
 
@@ -275,7 +435,7 @@ class Florence2ForObjectDetectionModel(ObjectDetectionModel):
             crop = image.crop((x1, y1, x2, y2))
             
             # Save the cropped image to the output directory
-            crop.save(f"{output_dir}/crop_{i}.png")
+            crop.save(f"{output_dir}/crop_{i}.png", compress_level=1)
             
             # Print a message indicating the crop has been saved
             print(f"Cropped image saved to {output_dir}/crop_{i}.png")
\ No newline at end of file
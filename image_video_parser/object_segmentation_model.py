@@ -1,16 +1,104 @@
 import abc
+import threading
+import weakref
+from functools import lru_cache
 from typing import Optional
 import torch
 import numpy as np
 from PIL import Image
 
-from .utils import create_node_from_image, image_to_base64_string, resolve_image, try_get_source_ref_node_info, ImageRegion
+from .utils import create_node_from_image, crop_masked_region, image_to_base64_string, resolve_image_tensor, resolve_pil_image, try_get_source_ref_node_info, BBoxes, ImageRegion
 from sam2.sam2_image_predictor import SAM2ImagePredictor
 from llama_index.core.schema import NodeRelationship, Node
 
+def _freeze_sam2_settings(sam_settings: Optional[dict] = None) -> tuple:
+    """
+    Converts the predictor settings into a hashable value usable as a cache key for _load_sam2.
+
+    Args:
+        sam_settings (Optional[dict]): The settings forwarded to the predictor, list values such as
+            hydra_overrides_extra are converted to tuples.
+
+    Returns:
+        tuple: The settings as sorted (name, value) pairs.
+    """
+    return tuple(sorted(
+        (name, tuple(value) if isinstance(value, list) else value)
+        for name, value in (sam_settings or {}).items()
+    ))
+
+# lru_cache does not stop two threads from loading the same predictor at the same time
+_sam2_load_lock = threading.Lock()
+# The predictor holds the features of the image being segmented, so each shared predictor segments one
+# image at a time whatever the segmentation model or the workflow using it
+_sam2_predictor_locks: "weakref.WeakKeyDictionary[SAM2ImagePredictor, threading.Lock]" = weakref.WeakKeyDictionary()
+
+def _load_sam2(model_name: str, device: str, compile_model: bool = False, sam_settings: tuple = ()) -> SAM2ImagePredictor:
+    """
+    Loads the SAM2ImagePredictor, shared by all the segmentation models of the process.
+
+    The arguments are forwarded positionally to the cached loader, so calls relying on the defaults
+    share the entry of the explicit ones; the settings are frozen with _freeze_sam2_settings. The
+    predictor must only be used while holding the lock returned by _get_sam2_predictor_lock.
+
+    Args:
+        model_name (str): The name of the pretrained SAM2 model.
+        device (str): The device to load the model on.
+        compile_model (bool): Whether to compile the image encoder and mask decoder with torch.compile.
+        sam_settings (tuple): Additional settings forwarded to the predictor, as returned by _freeze_sam2_settings.
+
+    Returns:
+        SAM2ImagePredictor: The predictor instance.
+    """
+    with _sam2_load_lock:
+        return _load_sam2_predictor(model_name, device, compile_model, sam_settings)
+
+def _get_sam2_predictor_lock(predictor: SAM2ImagePredictor) -> threading.Lock:
+    """
+    Retrieves the lock serializing the segmentations run with a predictor loaded by _load_sam2.
+
+    Args:
+        predictor (SAM2ImagePredictor): The predictor returned by _load_sam2.
+
+    Returns:
+        threading.Lock: The lock of the predictor.
+    """
+    return _sam2_predictor_locks[predictor]
+
+@lru_cache(maxsize=2)
+def _load_sam2_predictor(model_name: str, device: str, compile_model: bool, sam_settings: tuple) -> SAM2ImagePredictor:
+    """
+    Loads and caches the SAM2ImagePredictor, use _load_sam2 instead.
+
+    Args:
+        model_name (str): The name of the pretrained SAM2 model.
+        device (str): The device to load the model on.
+        compile_model (bool): Whether to compile the image encoder and mask decoder with torch.compile.
+        sam_settings (tuple): Additional settings forwarded to the predictor, as returned by _freeze_sam2_settings.
+
+    Returns:
+        SAM2ImagePredictor: The predictor instance.
+    """
+    predictor = SAM2ImagePredictor.from_pretrained(model_name, device=device, **dict(sam_settings))
+    predictor.model.to(memory_format=torch.channels_last)
+    if compile_model:
+        # The predictor calls the submodules directly, compiling the top level module would have no effect.
+        # Images are always resized to the same resolution, only the number of boxes varies
+        predictor.model.image_encoder = torch.compile(predictor.model.image_encoder)
+        predictor.model.sam_mask_decoder = torch.compile(predictor.model.sam_mask_decoder, dynamic=True)
+
+        # Warm up once so the compilation does not happen on the first user request
+        size = predictor.model.image_size
+        with torch.inference_mode(), torch.autocast(device_type=predictor.device.type, dtype=torch.bfloat16):
+            predictor.set_image(Image.new("RGB", (size, size)))
+            predictor.predict(box=np.array([[0, 0, size, size]], dtype=np.float32))
+        predictor.reset_predictor()
+    _sam2_predictor_locks[predictor] = threading.Lock()
+    return predictor
+
 class ImageSegmentationModel(abc.ABC):
     @abc.abstractmethod
-    def segment_image(self, image_node: Node, **kwargs) -> list[ImageRegion]:
+    def segment_image(self, image_node: Node, **kwargs) -> list[Node]:
         pass
 
 
@@ -31,14 +119,17 @@ class SamForImageSegmentation(ImageSegmentationModel):
     },
 
     _model: Optional[SAM2ImagePredictor] = None
+    _stream: Optional[torch.cuda.Stream] = None
     
     def __init__(
             self,
             model_name: str,
-            device: str = "cpu",
+            device: Optional[str] = None,
+            compile_model: bool = False,
         ):
         self._model_name = model_name
-        self._device = device
+        self._compile_model = compile_model
+        self._device = device or ("cuda" if torch.cuda.is_available() else "cpu")
 
 
     def _get_or_create_sam2(self) -> SAM2ImagePredictor:
@@ -49,47 +140,65 @@ class SamForImageSegmentation(ImageSegmentationModel):
             Owlv2ForObjectDetection: The object detection model instance.
         """
         if self._model is None:
-            self._model = SAM2ImagePredictor.from_pretrained(self._model_name, device_map=self._device, device=self._device) #, **self._default_configuration)
+            self._model = _load_sam2(self._model_name, self._device, self._compile_model, _freeze_sam2_settings()) #, **self._default_configuration)
         return self._model
 
 
-    def segment_image(self, image_node: Node, bbox_list: list[ImageRegion] = None) -> list[Node]:
+    def _get_or_create_stream(self) -> Optional[torch.cuda.Stream]:
+        """
+        Retrieves or creates the CUDA stream the segmentation runs on.
+
+        Running on a dedicated stream lets the segmentation kernels overlap with the ones of the object
+        detection, which runs on the default stream.
+
+        Returns:
+            Optional[torch.cuda.Stream]: The segmentation stream, or None when not running on CUDA.
+        """
+        if self._stream is None and torch.device(self._device).type == "cuda":
+            self._stream = torch.cuda.Stream(device=self._device)
+        return self._stream
+
+    def segment_image(self, image_node: Node, bboxes: Optional[BBoxes | list[ImageRegion]] = None) -> list[Node]:
         """
-        Parses an image node by cropping it into smaller image chunks based on the provided annotations.
+        Parses an image node by cropping it into smaller image chunks based on the provided bounding boxes.
 
         Args:
             image_node (Node): The image node to be parsed.
-            configuration (dict): The configuration containing bounding box annotations.
+            bboxes (Optional[BBoxes | list[ImageRegion]]): The bounding boxes of the objects to segment.
 
         Returns:
             list[Node]: A list of image chunks generated from the cropping process.
         """
-        img = Image.open(resolve_image(image_node)).convert("RGB")
+        if isinstance(bboxes, list):
+            bboxes = BBoxes.from_regions(bboxes)
+        if bboxes is None or len(bboxes) == 0:
+            return []
+
+        img = resolve_pil_image(image_node)
 
         predictor = self._get_or_create_sam2()
 
-        with torch.inference_mode(), torch.autocast(self._device, dtype=torch.bfloat16):
-            predictor.set_image(img)
-                
-            annotations = []
-            for bbox in bbox_list:
-                x1, y1, x2, y2 = bbox.x1, bbox.y1, bbox.x2, bbox.y2
-                annotations.append(predictor.predict(box=(x1, y1, x2, y2)))
-
-            # Initialize a list to hold the generated image chunks
-            image_chunks: list[Node] = []
-            # Iterate over the annotations and corresponding bounding boxes
-            for ann, bbox in zip(annotations, bbox_list):
-                # Extract the coordinates of the bounding box
-                box = bbox.x1, bbox.y1, bbox.x2, bbox.y2
-                # Find the index of the best mask in the annotation array
-                best_mask_idx = ann[1].argmax().item()
-                # Create a mask from the annotation array
-                mask = Image.fromarray((ann[0][best_mask_idx] * 255).astype(np.uint8))
-                # Composite the original image with a new RGB image using the mask
-                masked_image = Image.composite(img, Image.new("RGB", img.size), mask)
-                # Crop the masked image to the bounding box dimensions
-                cropped_image = masked_image.crop(box)
+        # Decode the masks for all the bounding boxes in a single batched forward. The lower level
+        # _predict is used instead of predict so the masks stay on the device instead of being
+        # copied back to the host as full size float arrays. These private methods are why the sam2
+        # revision is pinned in pyproject.toml
+        # Initialize a list to hold the generated image chunks
+        image_chunks: list[Node] = []
+        # Run on the segmentation stream, this is a no-op when not running on CUDA
+        with torch.cuda.stream(self._get_or_create_stream()):
+            with _get_sam2_predictor_lock(predictor), torch.inference_mode(), torch.autocast(device_type=predictor.device.type, dtype=torch.bfloat16):
+                predictor.set_image(img)
+                _, _, _, unnorm_box = predictor._prep_prompts(None, None, bboxes.boxes, None, normalize_coords=True)
+                masks, scores, _ = predictor._predict(None, None, boxes=unnorm_box)
+
+                # Keep the best mask of each bounding box
+                best_masks = masks[torch.arange(len(masks), device=masks.device), scores.argmax(dim=1)]
+
+            img_t = resolve_image_tensor(image_node, device=best_masks.device)
+            # Iterate over the predicted masks and corresponding bounding boxes
+            for mask, box in zip(best_masks, bboxes.boxes.astype(np.int32).tolist()):
+                # Crop the bounding box and apply the best predicted mask to the cropped region
+                cropped_image = crop_masked_region(img_t, mask, box)
 
                 # Prepare metadata for the image chunk
                 x1, y1, x2, y2 = box
@@ -102,7 +211,6 @@ class SamForImageSegmentation(ImageSegmentationModel):
                 image_chunk.relationships[NodeRelationship.PARENT] = image_node.as_related_node_info()
                 # Append the created image chunk to the list
                 image_chunks.append(image_chunk)
-                # Send an event indicating that an image chunk has been generated
 
         children_collection = image_node.relationships.get(NodeRelationship.CHILD, [])
         image_node.relationships[NodeRelationship.CHILD] = children_collection + [c.as_related_node_info() for c in image_chunks[1:]]
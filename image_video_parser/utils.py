@@ -1,9 +1,17 @@
 import base64
+import threading
+from dataclasses import dataclass, field
 from PIL import Image
 from io import BytesIO
+import numpy as np
+import torch
+import torchvision
+from torchvision.io import ImageReadMode
 from llama_index.core.schema import RelatedNodeInfo, BaseNode, MediaResource, Node
 import requests
 
+_thread_local = threading.local()
+
 class ImageRegion:
     """
     Represents a region within an image, typically used for object detection or segmentation tasks.
@@ -39,6 +47,67 @@ class ImageRegion:
         self.label = label
         self.score = score
 
+def crop_masked_region(image: torch.Tensor, mask: torch.Tensor, box: tuple[int, int, int, int]) -> Image.Image:
+    """
+    Crops a region of an image, blacking out the pixels outside of the mask.
+
+    The region is cropped before applying the mask and stays on the device of the tensors, only
+    the pixels of the masked region are copied back to the host.
+
+    Args:
+        image (torch.Tensor): The RGB image, with shape (3, H, W) and dtype uint8.
+        mask (torch.Tensor): The mask of the object, with shape (H, W).
+        box (tuple[int, int, int, int]): The (x1, y1, x2, y2) coordinates of the region, clamped to the image bounds.
+
+    Returns:
+        PIL.Image.Image: The masked crop of the region.
+    """
+    height, width = image.shape[1:]
+    x1, y1, x2, y2 = (int(v) for v in box)
+    x1, y1, x2, y2 = max(x1, 0), max(y1, 0), min(x2, width), min(y2, height)
+
+    mask_region = mask[y1:y2, x1:x2] > 0
+    cropped_region = image[:, y1:y2, x1:x2] * mask_region
+    return Image.fromarray(cropped_region.permute(1, 2, 0).cpu().numpy())
+
+@dataclass
+class BBoxes:
+    """
+    Bounding boxes detected in an image, stored as contiguous arrays rather than one object per box.
+
+    Attributes:
+        boxes (np.ndarray): The (x1, y1, x2, y2) coordinates of the boxes, with shape (N, 4) and dtype float32.
+        labels (np.ndarray): The index of the label of each box in label_names, with shape (N,) and dtype int32.
+        scores (np.ndarray): The confidence score of each box, with shape (N,) and dtype float32.
+        label_names (list[str]): The labels the boxes refer to, typically the text queries of the detection.
+    """
+    boxes: np.ndarray
+    labels: np.ndarray
+    scores: np.ndarray
+    label_names: list[str] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.boxes)
+
+    @classmethod
+    def from_regions(cls, regions: list[ImageRegion]) -> "BBoxes":
+        """
+        Creates the bounding boxes from a list of ImageRegion objects.
+
+        Args:
+            regions (list[ImageRegion]): The regions to convert.
+
+        Returns:
+            BBoxes: The bounding boxes of the regions.
+        """
+        label_names = list(dict.fromkeys(str(r.label) for r in regions))
+        return cls(
+            boxes=np.array([[r.x1, r.y1, r.x2, r.y2] for r in regions], dtype=np.float32).reshape(-1, 4),
+            labels=np.array([label_names.index(str(r.label)) for r in regions], dtype=np.int32),
+            scores=np.array([r.score for r in regions], dtype=np.float32),
+            label_names=label_names,
+        )
+
 def try_get_source_ref_node_info(node: BaseNode) -> RelatedNodeInfo:
     """
     Retrieves the RelatedNodeInfo for the source of the given node.
@@ -72,8 +141,12 @@ def image_to_raw_bytes(pil_image: Image.Image, format="JPEG") -> bytes:
     Returns:
         bytes: The raw bytes of the image.
     """
-    # Create a BytesIO object to store the image data in memory
-    buffered = BytesIO()
+    # Reuse the BytesIO object of the current thread to store the image data in memory
+    buffered = getattr(_thread_local, "buffer", None)
+    if buffered is None:
+        buffered = _thread_local.buffer = BytesIO()
+    buffered.seek(0)
+    buffered.truncate(0)
     
     # Save the PIL image to the BytesIO object in the specified format
     pil_image.save(buffered, format=format)
@@ -148,10 +221,137 @@ def resolve_image(media_resource_or_node: MediaResource|Node) -> bytes:
     if media_resource.path:
         return BytesIO(base64.b64decode(open(media_resource.path, "rb"))).getvalue()
 
+def attach_pil_image(node: Node, image: Image.Image) -> None:
+    """
+    Attaches an already decoded PIL image to a node.
+
+    The image is kept as a private attribute, it is not serialized with the node and lets
+    downstream consumers skip decoding the base64 encoded image resource again.
+
+    Args:
+        node (Node): The image node.
+        image (PIL.Image.Image): The decoded image of the node.
+    """
+    node._pil_image = image
+
+def resolve_pil_image(node: Node) -> Image.Image:
+    """
+    Resolves the PIL image of an image node.
+
+    Returns the image attached to the node if any, otherwise decodes the image resource
+    and attaches the result to the node for the next calls.
+
+    Args:
+        node (Node): The image node.
+
+    Returns:
+        PIL.Image.Image: The RGB image of the node.
+    """
+    image = getattr(node, "_pil_image", None)
+    if image is None:
+        media_resource = node.image_resource
+        # MediaResource stores binary data base64 encoded
+        raw_bytes = base64.b64decode(media_resource.data) if media_resource.data else resolve_image(media_resource)
+        image = Image.open(BytesIO(raw_bytes)).convert("RGB")
+        attach_pil_image(node, image)
+    return image
+
+def ensure_image_resource_data(node: Node) -> Node:
+    """
+    Ensures the image resource of a node holds base64 encoded data.
+
+    Source nodes are created without encoding their image. Before the node is hashed, serialized or
+    sent to the multi-modal language model, the attached image is encoded as a compact JPEG once and
+    stored in the image resource.
+
+    Args:
+        node (Node): The image node.
+
+    Returns:
+        Node: The same node, with the data of its image resource set.
+    """
+    media_resource = node.image_resource
+    if not media_resource.data:
+        media_resource.data = image_to_base64_binary(resolve_pil_image(node), format="JPEG")
+        media_resource.mimetype = "image/jpeg"
+    return node
+
+def attach_image_tensor(node: Node, image_tensor: torch.Tensor) -> None:
+    """
+    Attaches an already decoded image tensor to a node.
+
+    Like the PIL image, the tensor is kept as a private attribute and is not serialized with the node.
+
+    Args:
+        node (Node): The image node.
+        image_tensor (torch.Tensor): The decoded RGB image of the node, with shape (3, H, W) and dtype uint8.
+    """
+    node._image_tensor = image_tensor
+
+def resolve_image_tensor(node: Node, device: torch.device | str = "cpu") -> torch.Tensor:
+    """
+    Resolves the image of an image node as a tensor.
+
+    Returns the tensor attached to the node if any, otherwise converts its PIL image.
+
+    Args:
+        node (Node): The image node.
+        device (torch.device | str): The device the tensor should live on.
+
+    Returns:
+        torch.Tensor: The RGB image of the node, with shape (3, H, W) and dtype uint8.
+    """
+    image_tensor = getattr(node, "_image_tensor", None)
+    if image_tensor is None:
+        image_tensor = torch.from_numpy(np.asarray(resolve_pil_image(node))).permute(2, 0, 1)
+        attach_image_tensor(node, image_tensor)
+    return image_tensor.to(device)
+
+def create_node_from_image_path(image_path: str) -> Node:
+    """
+    Creates a new node from an image file.
+
+    JPEG files are decoded with nvJPEG when CUDA is available, the decoded tensor is attached to
+    the node next to the PIL image so it can be reused by the following steps. The formats
+    torchvision cannot decode to a single 8-bit RGB image, such as BMP, TIFF, 16-bit PNG or
+    animated GIF, are decoded with PIL.
+    The image is not encoded, call ensure_image_resource_data before hashing or serializing the node.
+
+    Args:
+        image_path (str): The path of the image file.
+
+    Returns:
+        Node: The new node created from the image file.
+    """
+    raw_bytes = torchvision.io.read_file(image_path)
+    try:
+        if torch.cuda.is_available() and raw_bytes[:2].tolist() == [0xFF, 0xD8]:
+            image_tensor = torchvision.io.decode_jpeg(raw_bytes, mode=ImageReadMode.RGB, device="cuda")
+        else:
+            image_tensor = torchvision.io.decode_image(raw_bytes, mode=ImageReadMode.RGB)
+    except RuntimeError:
+        image_tensor = None
+
+    # Animated GIFs are decoded into a (N, 3, H, W) tensor of frames, PIL keeps the first one
+    if image_tensor is not None and image_tensor.ndim == 3 and image_tensor.dtype == torch.uint8:
+        image = Image.fromarray(image_tensor.permute(1, 2, 0).cpu().numpy())
+    else:
+        # The tensor is created from the PIL image when needed
+        image_tensor = None
+        image = Image.open(image_path).convert("RGB")
+    new_node = Node(image_resource=MediaResource())
+    attach_pil_image(new_node, image)
+    if image_tensor is not None:
+        attach_image_tensor(new_node, image_tensor)
+    return new_node
+
 def create_node_from_base_64_string(base64_string: str) -> Node:
     """
     Creates a new node from a base64 string.
 
+    The decoded image is attached to the node so it can be reused by the following steps, it is
+    not encoded again, call ensure_image_resource_data before hashing or serializing the node.
+
     Args:
         base64_string (str): The base64 string to be associated with the new node.
 
@@ -159,9 +359,8 @@ def create_node_from_base_64_string(base64_string: str) -> Node:
         Node: The new node created from the base64 string.
     """
     image = Image.open(BytesIO(base64.b64decode(base64_string)))
-    new_node = Node(
-        image_resource=MediaResource(data=image_to_base64_binary(image, format="JPEG"),image_mimetype="image/jpg")
-    )
+    new_node = Node(image_resource=MediaResource())
+    attach_pil_image(new_node, image.convert("RGB"))
     return new_node
     
 def create_node_from_image(image: Image.Image, metadata: dict = None) -> Node:
@@ -177,6 +376,7 @@ def create_node_from_image(image: Image.Image, metadata: dict = None) -> Node:
     """
 
     new_node = Node(
-        image_resource=MediaResource(data=image_to_base64_binary(image, format="JPEG"),image_mimetype="image/jpg", metadata=metadata)
+        image_resource=MediaResource(data=image_to_base64_binary(image, format="JPEG"),mimetype="image/jpeg", metadata=metadata)
     )
+    attach_pil_image(new_node, image)
     return new_node
\ No newline at end of file
@@ -4,34 +4,43 @@ import shutil
 import asyncio
 
 from image_video_parser.image_node_parser_workflow import ImageNodeParserWorkflow
-from llama_index.multi_modal_llms.openai import OpenAIMultiModal
+from image_video_parser.multi_modal_llms import PooledAzureOpenAIMultiModal, PooledOpenAIMultiModal
 from dotenv import load_dotenv
 import os
 
 from image_video_parser.object_detection_model import Florence2ForObjectDetectionModel, OwlV2ObjectDetectionModel
 from image_video_parser.object_segmentation_model import SamForImageSegmentation
-from image_video_parser.utils import is_image, resolve_image
+from image_video_parser.utils import is_image, resolve_pil_image
 
 load_dotenv()
 
+# Created once so the HTTP/2 connection pool stays warm across images and the concurrent
+# description requests are multiplexed over a few connections
+azure_openai_mm_llm = PooledOpenAIMultiModal(
+    model=os.getenv("MODEL"),
+    api_key=os.getenv("OPENAI_API_KEY"),
+    max_new_tokens=300,
+)
+# azure_openai_mm_llm = PooledAzureOpenAIMultiModal(
+#     engine=os.getenv("MODEL"),
+#     model=os.getenv("MODEL"),
+#     api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+#     api_version=os.getenv("API_VERSION"),
+#     max_new_tokens=300,
+# )
+
 async def main():
     # remove the ./output folder
     shutil.rmtree("./output", ignore_errors=True)
     shutil.os.mkdir("./output")
     shutil.os.mkdir("./output/cropped_images")
     shutil.os.mkdir("./output/segmented_images")
-    
-    azure_openai_mm_llm = OpenAIMultiModal(
-        model=os.getenv("MODEL"),
-        api_key=os.getenv("OPENAI_API_KEY"),
-        max_new_tokens=300,
-    )
 
     workflow = ImageNodeParserWorkflow(verbose=True)
     workflow.multi_modal_llm = azure_openai_mm_llm
     # workflow.object_detection_model = Florence2ForObjectDetectionModel(save_cropped_images=True)
     workflow.object_detection_model = OwlV2ObjectDetectionModel(save_cropped_images=True, output_dir="./output/cropped_images")
-    workflow.image_segmentation_model = SamForImageSegmentation(model_name="facebook/sam2.1-hiera-large", device="cpu")
+    workflow.image_segmentation_model = SamForImageSegmentation(model_name="facebook/sam2.1-hiera-large")
     
     # result = await workflow.run(image_path="./images/ikea.png", prompt="all the chairs")
     result = await workflow.run(image_path="./images/diablo_menu.png")
@@ -42,7 +51,7 @@ async def main():
 
     for chunk in result["chunks"]:
         if isinstance(chunk, Node) and is_image(chunk.image_resource):
-            Image.open(resolve_image(chunk)).save(f"./output/segmented_images/{chunk.node_id}.png")
+            resolve_pil_image(chunk).save(f"./output/segmented_images/{chunk.node_id}.png", compress_level=1)
 
 if __name__ == "__main__":
     asyncio.run(main())
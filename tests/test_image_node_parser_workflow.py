@@ -0,0 +1,56 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+pytest.importorskip("sam2")
+pytest.importorskip("transformers")
+
+from llama_index.core.schema import Node, NodeRelationship
+from PIL import Image
+
+from image_video_parser.image_node_parser_workflow import ImageNodeParserWorkflow
+from image_video_parser.object_detection_model import ObjectDetectionModel
+from image_video_parser.object_segmentation_model import ImageSegmentationModel
+from image_video_parser.utils import BBoxes, create_node_from_image, resolve_pil_image, try_get_source_ref_node_info
+
+
+class FixedObjectDetectionModel(ObjectDetectionModel):
+    def detect_bboxes(self, image_node: Node, **kwargs) -> BBoxes:
+        return BBoxes(
+            boxes=np.array([[0, 0, 8, 8]], dtype=np.float32),
+            labels=np.array([0], dtype=np.int32),
+            scores=np.array([1.0], dtype=np.float32),
+            label_names=["object"],
+        )
+
+
+class CroppingImageSegmentationModel(ImageSegmentationModel):
+    def segment_image(self, image_node: Node, bboxes: BBoxes = None) -> list[Node]:
+        chunks = []
+        for x1, y1, x2, y2 in bboxes.boxes.astype(np.int32).tolist():
+            chunk = create_node_from_image(resolve_pil_image(image_node).crop((x1, y1, x2, y2)))
+            chunk.relationships[NodeRelationship.SOURCE] = try_get_source_ref_node_info(image_node)
+            chunk.relationships[NodeRelationship.PARENT] = image_node.as_related_node_info()
+            chunks.append(chunk)
+        return chunks
+
+
+def test_source_node_keeps_its_image_data_on_the_prompt_path(tmp_path):
+    image_path = tmp_path / "image.png"
+    Image.new("RGBA", (16, 16), "red").save(image_path)
+
+    workflow = ImageNodeParserWorkflow()
+    workflow.object_detection_model = FixedObjectDetectionModel()
+    workflow.image_segmentation_model = CroppingImageSegmentationModel()
+
+    async def run():
+        return await workflow.run(image_path=str(image_path), prompt="object")
+
+    result = asyncio.run(run())
+
+    source = result["source"]
+    assert source.image_resource.data
+    assert source.image_resource.mimetype == "image/jpeg"
+    assert source.hash == Node(image_resource=source.image_resource).hash
+    assert all(chunk.relationships[NodeRelationship.PARENT].hash == source.hash for chunk in result["chunks"])
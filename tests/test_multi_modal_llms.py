@@ -0,0 +1,36 @@
+import pytest
+
+pytest.importorskip("h2")
+pytest.importorskip("llama_index.multi_modal_llms.azure_openai")
+
+from image_video_parser.multi_modal_llms import PooledAzureOpenAIMultiModal, PooledOpenAIMultiModal, create_pooled_async_http_client
+
+
+def test_openai_multi_modal_sends_async_requests_through_the_pooled_client():
+    async_http_client = create_pooled_async_http_client()
+
+    llm = PooledOpenAIMultiModal(model="gpt-4o", api_key="test", async_http_client=async_http_client)
+
+    assert llm._aclient._client is async_http_client
+
+
+def test_azure_openai_multi_modal_sends_async_requests_through_the_pooled_client():
+    async_http_client = create_pooled_async_http_client()
+
+    llm = PooledAzureOpenAIMultiModal(
+        engine="gpt-4o",
+        model="gpt-4o",
+        api_key="test",
+        api_version="2024-06-01",
+        azure_endpoint="https://example.openai.azure.com",
+        async_http_client=async_http_client,
+    )
+
+    assert llm._aclient._client is async_http_client
+    assert llm._aclient.base_url.host == "example.openai.azure.com"
+
+
+def test_pooled_async_http_client_uses_http2():
+    async_http_client = create_pooled_async_http_client()
+
+    assert async_http_client._transport._pool._http2
@@ -0,0 +1,22 @@
+import pytest
+
+pytest.importorskip("torchvision")
+pytest.importorskip("llama_index.core")
+
+from PIL import Image
+
+from image_video_parser.utils import create_node_from_image_path, resolve_image_tensor, resolve_pil_image
+
+
+def test_create_node_from_animated_gif_path_keeps_first_frame(tmp_path):
+    image_path = tmp_path / "animated.gif"
+    frames = [Image.new("RGB", (32, 24), color) for color in ("red", "blue")]
+    frames[0].save(image_path, save_all=True, append_images=frames[1:])
+
+    node = create_node_from_image_path(str(image_path))
+
+    image = resolve_pil_image(node)
+    assert image.mode == "RGB"
+    assert image.size == (32, 24)
+    assert image.getpixel((0, 0)) == (255, 0, 0)
+    assert tuple(resolve_image_tensor(node).shape) == (3, 24, 32)